@@ -1,19 +1,74 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Request, BackgroundTasks
+from fastapi.responses import ORJSONResponse, FileResponse, StreamingResponse
 from pydantic import BaseModel
 from ocr_service import OCRService
+from contextlib import asynccontextmanager
+from typing import Optional
 import uvicorn
+import asyncio
+import logging
 import os
 
 from fastapi.middleware.cors import CORSMiddleware
 
+# uvicorn and gunicorn only configure their own loggers, so set up the root logger for ours
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# OCR Service, created on startup so each worker process gets its own Vision client
+# (the client holds gRPC channels that are not fork-safe)
+ocr_service: OCRService = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ocr_service
+    ocr_service = OCRService()
+    await asyncio.to_thread(ocr_service.warm_up)
+    yield
+
 app = FastAPI(
     title="OCR API", 
     description="API to extract text from images using Google Cloud Vision",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
+# Constants
+MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
+MAX_BATCH_SIZE = 20
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+SUPPORTED_EXTENSION_SET = frozenset(SUPPORTED_EXTENSIONS)
+UNSUPPORTED_EXTENSION_MESSAGE = f"File {{filename}}: Only {', '.join(SUPPORTED_EXTENSIONS)} images are supported."
+READ_CHUNK_SIZE = 64 * 1024  # 64KB
+# Leading bytes of the supported formats (JPEG SOI marker, PNG signature)
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n")
+MULTIPART_OVERHEAD = 64 * 1024  # 64KB allowance for multipart boundaries and part headers
+
+# Upload size middleware
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """
+    Reject obviously oversized uploads from the Content-Length header, before the multipart body is parsed.
+    The exact per-file limit is still enforced while each file is read.
+    """
+    path = request.url.path
+    if request.method == "POST" and path.startswith("/ocr"):
+        max_files = MAX_BATCH_SIZE if path.startswith("/ocr-batch") else 1
+        max_body_size = max_files * MAX_FILE_SIZE + MULTIPART_OVERHEAD
+        content_length = request.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > max_body_size:
+            return ORJSONResponse(
+                status_code=413,
+                content={"detail": f"Request too large. Maximum size allowed is {max_body_size // (1024 * 1024)}MB."}
+            )
+    return await call_next(request)
+
 # Add CORS middleware
+# Added last so it wraps the other middleware and early error responses keep their CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -22,20 +77,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Constants
-MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
-MAX_BATCH_SIZE = 20
-SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png')
-
-# Initialize OCR Service
-ocr_service = OCRService()
-
 # Pydantic Models
 class OCRResponse(BaseModel):
     text: str
     confidence: float = 0.0
-    metadata: dict = None
-    message: str = None
+    metadata: Optional[dict] = None
+    message: Optional[str] = None
 
 class ErrorResponse(BaseModel):
     detail: str
@@ -50,32 +97,130 @@ class BatchOCRResponse(BaseModel):
 
 def validate_image(file: UploadFile):
     """
-    Helper function to validate an image file.
+    Helper function to validate an image file's type and extension.
+    The file size is checked while reading, in read_image.
     """
     # Validate MIME type
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail=f"File {file.filename} is not an image.")
 
     # Validate file extension
-    if not file.filename.lower().endswith(SUPPORTED_EXTENSIONS):
+    extension = os.path.splitext(file.filename)[1].lower()
+    if extension not in SUPPORTED_EXTENSION_SET:
          raise HTTPException(
              status_code=400, 
-             detail=f"File {file.filename}: Only {', '.join(SUPPORTED_EXTENSIONS)} images are supported."
+             detail=UNSUPPORTED_EXTENSION_MESSAGE.format(filename=file.filename)
          )
 
-    # Validate file size
-    file.file.seek(0, 2)
-    file_size = file.file.tell()
-    file.file.seek(0)  # Reset to beginning
+async def read_image(file: UploadFile) -> bytes:
+    """
+    Helper function to read an uploaded image in chunks while enforcing the size limit.
+    Stops as soon as the file goes over MAX_FILE_SIZE, so oversized uploads are never fully loaded.
+    Files whose leading bytes are not a JPEG or PNG signature are rejected on the first chunk.
+    """
+    buf = bytearray()
+    while chunk := await file.read(READ_CHUNK_SIZE):
+        if not buf and not chunk.startswith(IMAGE_SIGNATURES):
+            raise HTTPException(
+                status_code=415,
+                detail=f"File {file.filename} is not a valid JPEG or PNG image."
+            )
+        buf += chunk
+        if len(buf) > MAX_FILE_SIZE:
+            raise HTTPException(
+                status_code=413, 
+                detail=f"File {file.filename} too large. Maximum size allowed is {MAX_FILE_SIZE // (1024 * 1024)}MB."
+            )
 
-    if file_size > MAX_FILE_SIZE:
+    if not buf:
+        raise HTTPException(status_code=400, detail=f"File {file.filename} is empty.")
+
+    return bytes(buf)
+
+def validate_batch_size(files: list[UploadFile]):
+    """
+    Helper function to validate the number of files in a batch.
+    """
+    if len(files) > MAX_BATCH_SIZE:
         raise HTTPException(
-            status_code=413, 
-            detail=f"File {file.filename} too large. Maximum size allowed is {MAX_FILE_SIZE // (1024 * 1024)}MB."
+            status_code=400,
+            detail=f"Too many files. Maximum batch size is {MAX_BATCH_SIZE} images."
         )
-    
-    if file_size == 0:
-        raise HTTPException(status_code=400, detail=f"File {file.filename} is empty.")
+
+async def read_batch_files(files: list[UploadFile]) -> tuple[dict, dict]:
+    """
+    Helper function to validate and read every file in a batch.
+    All files are checked for type and extension before any of them is read, then the
+    valid ones are read concurrently.
+    Returns (contents, failures): the bytes of each valid file and a BatchOCRResult
+    for each invalid one, both keyed by the file's index in the batch.
+    """
+    failures = {}
+
+    def _failure(file: UploadFile, e: Exception) -> BatchOCRResult:
+        # For batch processing, we continue even if one file fails validation or cannot be read
+        if isinstance(e, HTTPException):
+            return BatchOCRResult.model_construct(
+                filename=file.filename,
+                text="",
+                confidence=0.0,
+                message=f"Validation error: {e.detail}"
+            )
+        return build_batch_result(file.filename, e)
+
+    valid = []
+    for index, file in enumerate(files):
+        try:
+            validate_image(file)
+            valid.append(index)
+        except Exception as e:
+            failures[index] = _failure(file, e)
+
+    reads = await asyncio.gather(
+        *(read_image(files[index]) for index in valid),
+        return_exceptions=True
+    )
+
+    contents = {}
+    for index, content in zip(valid, reads):
+        if isinstance(content, Exception):
+            failures[index] = _failure(files[index], content)
+        elif isinstance(content, BaseException):
+            # Cancellation is not a per-file failure
+            raise content
+        else:
+            contents[index] = content
+    return contents, failures
+
+def build_batch_result(filename: str, ocr_result) -> BatchOCRResult:
+    """
+    Helper function to build a BatchOCRResult from an OCR result or the exception it raised.
+    The values come from our own OCR service, so the model is constructed without validation.
+    """
+    if isinstance(ocr_result, BaseException):
+        return BatchOCRResult.model_construct(
+            filename=filename,
+            text="",
+            confidence=0.0,
+            message=f"Error: {str(ocr_result)}"
+        )
+
+    return BatchOCRResult.model_construct(
+        filename=filename,
+        text=ocr_result["text"],
+        confidence=ocr_result["confidence"],
+        metadata=ocr_result.get("metadata"),
+        message="Success" if ocr_result["text"] else "No text found"
+    )
+
+def log_ocr_result(filename: str, result: dict):
+    """
+    Background task that logs a summary of an OCR result after the response has been sent.
+    """
+    logger.info(
+        "OCR completed for %s: text_len=%d confidence=%.2f",
+        filename, len(result["text"]), result["confidence"]
+    )
 
 async def validate_image_file(file: UploadFile = File(...)):
     """
@@ -92,17 +237,24 @@ def read_root():
 @app.post(
     "/ocr", 
     response_model=OCRResponse,
-    responses={400: {"model": ErrorResponse}, 413: {"model": ErrorResponse}, 500: {"model": ErrorResponse}},
+    responses={
+        400: {"model": ErrorResponse},
+        413: {"model": ErrorResponse},
+        415: {"model": ErrorResponse},
+        500: {"model": ErrorResponse}
+    },
     tags=["OCR"]
 )
-async def perform_ocr(file: UploadFile = Depends(validate_image_file)):
+async def perform_ocr(background_tasks: BackgroundTasks, file: UploadFile = Depends(validate_image_file)):
     """
     Accepts an image file and returns the extracted text and confidence score.
     - **file**: JPG/JPEG image file (max 5MB)
     """
+    content = await read_image(file)
+
     try:
-        content = await file.read()
-        result = ocr_service.extract_text(content)
+        result = await ocr_service.extract_text_async(content)
+        background_tasks.add_task(log_ocr_result, file.filename, result)
 
         if not result["text"]:
             return OCRResponse(
@@ -124,7 +276,12 @@ async def perform_ocr(file: UploadFile = Depends(validate_image_file)):
 @app.post(
     "/ocr-batch", 
     response_model=BatchOCRResponse,
-    responses={400: {"model": ErrorResponse}, 413: {"model": ErrorResponse}, 500: {"model": ErrorResponse}},
+    responses={
+        400: {"model": ErrorResponse},
+        413: {"model": ErrorResponse},
+        415: {"model": ErrorResponse},
+        500: {"model": ErrorResponse}
+    },
     tags=["OCR"]
 )
 async def perform_batch_ocr(files: list[UploadFile] = File(...)):
@@ -132,55 +289,84 @@ async def perform_batch_ocr(files: list[UploadFile] = File(...)):
     Accepts multiple image files and returns the extracted text and metadata for each.
     Maximum of 20 images per batch.
     """
-    if len(files) > MAX_BATCH_SIZE:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Too many files. Maximum batch size is {MAX_BATCH_SIZE} images."
-        )
-    
-    results = []
+    validate_batch_size(files)
+    pending, failures = await read_batch_files(files)
+
+    results = [None] * len(files)
+    for index, failure in failures.items():
+        results[index] = failure
+
+    # Failed images are returned as exceptions in place so they map back to the right file
+    outcomes = await ocr_service.extract_text_batch(list(pending.values()))
+
     successful_count = 0
-    
-    for file in files:
-        try:
-            # Validate each file
-            validate_image(file)
-            
-            content = await file.read()
-            ocr_result = ocr_service.extract_text(content)
-            
-            batch_result = BatchOCRResult(
-                filename=file.filename,
-                text=ocr_result["text"],
-                confidence=ocr_result["confidence"],
-                metadata=ocr_result.get("metadata"),
-                message="Success" if ocr_result["text"] else "No text found"
-            )
-            results.append(batch_result)
+    for index, outcome in zip(pending, outcomes):
+        results[index] = build_batch_result(files[index].filename, outcome)
+        if not isinstance(outcome, BaseException):
             successful_count += 1
-            
-        except HTTPException as e:
-            # For batch processing, we might want to continue even if one file fails validation
-            # But let's follow the standard and return a result with an error message or just append to results
-            results.append(BatchOCRResult(
-                filename=file.filename,
-                text="",
-                confidence=0.0,
-                message=f"Validation error: {e.detail}"
-            ))
-        except Exception as e:
-            results.append(BatchOCRResult(
-                filename=file.filename,
-                text="",
-                confidence=0.0,
-                message=f"Error: {str(e)}"
-            ))
 
-    return BatchOCRResponse(
+    # Results are built server-side, so skip validating them again (both here and in
+    # FastAPI's response_model check) by returning the serialized response directly
+    response = BatchOCRResponse.model_construct(
         results=results,
         total_processed=len(files),
         successful_processed=successful_count
     )
+    return ORJSONResponse(content=response.model_dump())
+
+@app.post(
+    "/ocr-batch/stream",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}},
+            "description": "One BatchOCRResult JSON object per line, in completion order."
+        },
+        400: {"model": ErrorResponse}
+    },
+    tags=["OCR"]
+)
+async def perform_batch_ocr_stream(files: list[UploadFile] = File(...)):
+    """
+    Same as /ocr-batch, but streams each result as newline-delimited JSON as soon as it is ready.
+    Results arrive in completion order, so use the filename to match them to the uploaded files.
+    Maximum of 20 images per batch.
+    """
+    validate_batch_size(files)
+    contents, failures = await read_batch_files(files)
+
+    async def _ocr(filename: str, content: bytes) -> BatchOCRResult:
+        try:
+            return build_batch_result(filename, await ocr_service.extract_text_async(content))
+        except Exception as e:
+            return build_batch_result(filename, e)
+
+    # Start the OCR calls now so they run while the response is being streamed
+    tasks = [
+        asyncio.create_task(_ocr(files[index].filename, content))
+        for index, content in contents.items()
+    ]
+
+    async def stream_results():
+        try:
+            for failure in failures.values():
+                yield failure.model_dump_json() + "\n"
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                yield result.model_dump_json() + "\n"
+        finally:
+            # Stop outstanding OCR calls if the client goes away mid-stream
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=max(2, os.cpu_count() or 1)
+    )
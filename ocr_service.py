@@ -1,45 +1,244 @@
 import os
+import asyncio
+import hashlib
+import threading
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache
+import grpc
 from google.cloud import vision
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable, DeadlineExceeded
 from google.oauth2 import service_account
 from dotenv import load_dotenv
 from PIL import Image
 from PIL.ExifTags import TAGS
+import numpy as np
+import piexif
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception_type
 import io
+import logging
+import struct
+from typing import Optional
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# gRPC channel options for the Vision client
+GRPC_CHANNEL_OPTIONS = [
+    # Same unlimited message sizes as the default transport, images can be large
+    ("grpc.max_send_message_length", -1),
+    ("grpc.max_receive_message_length", -1),
+    # Keep the warmed-up connection alive between requests
+    ("grpc.keepalive_time_ms", 30000),
+]
+
+# Retry transient Vision API errors (quota exhausted, unavailable, timeouts) with exponential backoff
+vision_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(initial=0.5, max=4),
+    retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable, DeadlineExceeded)),
+    reraise=True
+)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG IHDR (bit depth, colour type) mapped to the mode PIL opens it in
+PNG_MODES = {
+    (1, 0): "1", (2, 0): "L", (4, 0): "L", (8, 0): "L", (16, 0): "I;16",
+    (8, 2): "RGB", (16, 2): "RGB",
+    (1, 3): "P", (2, 3): "P", (4, 3): "P", (8, 3): "P",
+    (8, 4): "LA", (16, 4): "RGBA",
+    (8, 6): "RGBA", (16, 6): "RGBA",
+}
+# JPEG frame component counts mapped to PIL modes
+JPEG_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+# SOFn markers carry the frame size; C4, C8 and CC are DHT, JPG and DAC instead
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def _is_rational(value) -> bool:
+    return isinstance(value, tuple) and len(value) == 2 and all(isinstance(v, int) for v in value)
+
+def _exif_rational(value: tuple) -> float:
+    numerator, denominator = value
+    return numerator / denominator if denominator else float("nan")
+
+def _exif_value(value, tag_type, decode_bytes: bool = True):
+    """
+    Convert a piexif tag value to the value PIL would have returned for it.
+    """
+    if tag_type in (piexif.TYPES.Rational, piexif.TYPES.SRational):
+        # piexif returns (numerator, denominator) pairs, PIL returns them as floats.
+        # The spec type is only a hint: files may store these tags as e.g. SHORT, so check the value too
+        if _is_rational(value):
+            return _exif_rational(value)
+        if isinstance(value, tuple) and value and all(_is_rational(v) for v in value):
+            return tuple(_exif_rational(v) for v in value)
+        return value
+    if tag_type == piexif.TYPES.Byte and isinstance(value, tuple):
+        # piexif returns BYTE tags as a tuple of ints, PIL returns them as bytes
+        value = bytes(value)
+    if isinstance(value, bytes):
+        if tag_type == piexif.TYPES.Ascii:
+            # PIL returns ASCII tags as str without the trailing NUL
+            return value.decode(errors='replace').rstrip("\x00")
+        if decode_bytes:
+            return value.decode(errors='replace')
+    return value
+
+def _fast_dims(content: bytes) -> Optional[tuple[str, int, int, str]]:
+    """
+    Read (format, width, height, mode) straight from the PNG IHDR chunk or the JPEG SOF marker.
+    Returns None if the format is not recognised or the header cannot be parsed.
+    """
+    if content.startswith(PNG_SIGNATURE):
+        if len(content) < 26 or content[12:16] != b"IHDR":
+            return None
+        width, height, bit_depth, color_type = struct.unpack_from(">IIBB", content, 16)
+        mode = PNG_MODES.get((bit_depth, color_type))
+        return ("PNG", width, height, mode) if mode else None
+
+    if content.startswith(b"\xff\xd8"):
+        offset = 2
+        while offset + 4 <= len(content):
+            if content[offset] != 0xFF:
+                return None
+            marker = content[offset + 1]
+            if marker == 0xFF:
+                # Fill byte before the marker
+                offset += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                # Standalone markers have no length field
+                offset += 2
+                continue
+            if marker == 0xDA:
+                # Start of scan reached without a frame header
+                return None
+            segment_length, = struct.unpack_from(">H", content, offset + 2)
+            if marker == 0xE2 and content[offset + 4:offset + 8] == b"MPF\x00":
+                # Multi-picture file; PIL decides between JPEG and MPO from the MPF header
+                return None
+            if marker in JPEG_SOF_MARKERS:
+                if offset + 10 > len(content):
+                    return None
+                _precision, height, width, components = struct.unpack_from(">BHHB", content, offset + 4)
+                mode = JPEG_MODES.get(components)
+                return ("JPEG", width, height, mode) if mode else None
+            offset += 2 + segment_length
+
+    return None
+
 class OCRService:
-    def __init__(self, credentials_path: str = None):
+    # Vision accepts at most 16 images per batch_annotate_images call
+    MAX_IMAGES_PER_REQUEST = 16
+    # ...and rejects requests whose total size is over 10MB
+    MAX_REQUEST_BYTES = 10 * 1024 * 1024
+
+    # Built once and shared by every request, we only ever ask for document text detection
+    _FEATURES = (vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION),)
+
+    def __init__(
+        self,
+        credentials_path: str = None,
+        max_concurrency: int = None,
+        cache_size: int = None,
+        rate_limit: int = None
+    ):
         """
         Initialize the OCR Service.
         :param credentials_path: Path to the Google Cloud service account JSON file.
                                   If None, it will try to use GOOGLE_APPLICATION_CREDENTIALS env var.
+        :param max_concurrency: Maximum number of Vision API calls in flight at once.
+                                If None, it is read from the OCR_CONCURRENCY env var (default 8).
+        :param cache_size: Number of OCR results kept in the in-process LRU cache.
+                           If None, it is read from the OCR_CACHE_SIZE env var (default 1024).
+        :param rate_limit: Maximum number of images sent to the Vision API per second.
+                           If None, it is read from the VISION_RPS env var (default 30).
         """
+        credentials = None
         if credentials_path and os.path.exists(credentials_path):
-            self.client = vision.ImageAnnotatorClient.from_service_account_json(credentials_path)
-        else:
-            # This will use the default credentials if configured (e.g. via GOOGLE_APPLICATION_CREDENTIALS)
-            self.client = vision.ImageAnnotatorClient()
+            credentials = service_account.Credentials.from_service_account_file(credentials_path)
+        # If credentials is None, the default credentials are used (e.g. via GOOGLE_APPLICATION_CREDENTIALS)
+        self._channel = ImageAnnotatorGrpcTransport.create_channel(
+            credentials=credentials,
+            options=GRPC_CHANNEL_OPTIONS
+        )
+        self.client = vision.ImageAnnotatorClient(
+            transport=ImageAnnotatorGrpcTransport(channel=self._channel)
+        )
+
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("OCR_CONCURRENCY", "8"))
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+        # Client-side pacing so bursts do not exhaust the per-minute Vision quota
+        if rate_limit is None:
+            rate_limit = int(os.getenv("VISION_RPS", "30"))
+        self._limiter = AsyncLimiter(max_rate=rate_limit, time_period=1)
+
+        # Results keyed by the SHA-256 of the image bytes, so repeated images skip the Vision call.
+        # The cache is used from worker threads, hence a threading lock rather than an asyncio one.
+        if cache_size is None:
+            cache_size = int(os.getenv("OCR_CACHE_SIZE", "1024"))
+        self._cache = LRUCache(maxsize=cache_size)
+        self._cache_lock = threading.Lock()
+
+    def warm_up(self, timeout: float = 10.0):
+        """
+        Connect the gRPC channel ahead of the first request so no user pays for the TLS/HTTP2 handshake.
+        """
+        try:
+            grpc.channel_ready_future(self._channel).result(timeout=timeout)
+        except grpc.FutureTimeoutError:
+            logger.warning("Vision API channel not ready after %.1fs, continuing without warm-up", timeout)
 
     def extract_text(self, image_content: bytes) -> dict:
         """
         Extract text from image bytes using Google Cloud Vision OCR.
         Returns a dictionary with 'text' and 'confidence'.
         """
-        image = vision.Image(content=image_content)
-        
+        key = hashlib.sha256(image_content).digest()
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        return self._extract_text_retrying(key, image_content)
+
+    def _extract_text_uncached(self, key: bytes, image_content: bytes) -> dict:
         # Performs text detection on the image file
         # We use document_text_detection for better structural info and confidence scores
-        response = self.client.document_text_detection(image=image)
-        
-        # Log the full response for debugging (converting to dict for easier reading)
-        # In a real app, you might want to log to a file or logging service
-        print("--- Vision API Response Log ---")
-        # Using the proto message's __dict__ or just str(response)
-        # print(vision.AnnotatorResults.pb(response.full_text_annotation)) 
-        # A simpler way to see the structure:
-        print(f"Detected text length: {len(response.full_text_annotation.text)}")
-        print(response)
+        response = self._batch_annotate_images([self._build_request(image_content)]).responses[0]
+        result = self._parse_response(response, image_content)
+        self._cache_put(key, result)
+        return result
+
+    # The sync path retries the whole call here; the async paths retry in _run_limited
+    # so that every attempt goes through the rate limiter
+    _extract_text_retrying = vision_retry(_extract_text_uncached)
+
+    def _build_request(self, image_content: bytes) -> vision.AnnotateImageRequest:
+        return vision.AnnotateImageRequest(
+            image=vision.Image(content=image_content),
+            features=self._FEATURES
+        )
+
+    def _batch_annotate_images(self, requests: list):
+        return self.client.batch_annotate_images(requests=requests)
+
+    def _cache_get(self, key: bytes):
+        with self._cache_lock:
+            return self._cache.get(key)
+
+    def _cache_put(self, key: bytes, result: dict):
+        with self._cache_lock:
+            self._cache[key] = result
+
+    def _parse_response(self, response, image_content: bytes) -> dict:
+        """
+        Turn a single Vision AnnotateImageResponse into the result dictionary.
+        """
+        # Only log a summary; formatting the whole proto is slow and holds the GIL
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Vision API response: text_len=%d", len(response.full_text_annotation.text))
         
         if response.error.message:
             raise Exception(f"Google Cloud Vision OCR Error: {response.error.message}")
@@ -50,11 +249,11 @@ class OCRService:
         # Calculate average confidence
         # Vision API provides confidence for blocks, paragraphs, words, and symbols.
         # We'll take the average confidence of all pages detected.
-        confidences = []
-        for page in response.full_text_annotation.pages:
-            confidences.append(page.confidence)
-        
-        avg_confidence = sum(confidences) / len(confidences) if confidences else 0.0
+        confidences = np.fromiter(
+            (page.confidence for page in response.full_text_annotation.pages),
+            dtype=np.float64
+        )
+        avg_confidence = float(confidences.mean()) if confidences.size else 0.0
 
         return {
             "text": response.full_text_annotation.text,
@@ -62,37 +261,196 @@ class OCRService:
             "metadata": self.extract_metadata(image_content)
         }
 
-    def extract_metadata(self, image_content: bytes) -> dict:
+    async def extract_text_async(self, image_content: bytes) -> dict:
+        """
+        Async variant of extract_text.
+        Runs the blocking Vision call in a worker thread so the event loop stays free,
+        with at most max_concurrency calls in flight and at most rate_limit images per second.
+        """
+        key = hashlib.sha256(image_content).digest()
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        async with self._semaphore:
+            return await self._run_limited(1, self._extract_text_uncached, key, image_content)
+
+    @vision_retry
+    async def _run_limited(self, images: int, func, *args):
+        """
+        Run a blocking Vision call in a worker thread, taking one rate limiter token per image.
+        The retry wraps the limiter, so retried attempts are paced by VISION_RPS as well.
+        """
+        # Vision quota is counted per image, not per RPC
+        await self._limiter.acquire(images)
+        # Threads share the process memory, so the image bytes are handed over by
+        # reference; nothing is copied or pickled as it would be for a process pool
+        return await asyncio.to_thread(func, *args)
+
+    async def extract_text_batch(self, contents: list[bytes]) -> list:
+        """
+        Extract text from several images using as few Vision API calls as possible.
+        Images are sent in chunks that fit Vision's per-request limits and the chunks run concurrently.
+        Returns one entry per image, in order: the result dictionary or the exception raised for it.
+        """
+        keys = [hashlib.sha256(content).digest() for content in contents]
+        results = [self._cache_get(key) for key in keys]
+
+        # Only send images that are not cached, and each distinct image only once
+        misses = {}
+        for key, content, result in zip(keys, contents, results):
+            if result is None:
+                misses.setdefault(key, content)
+        miss_keys = list(misses)
+        miss_contents = list(misses.values())
+
+        chunks = self._chunk_requests(miss_contents)
+        chunk_results = await asyncio.gather(
+            *(self._annotate_batch_async(chunk) for chunk in chunks),
+            return_exceptions=True
+        )
+
+        fresh = []
+        for chunk, chunk_result in zip(chunks, chunk_results):
+            if isinstance(chunk_result, BaseException):
+                # The whole RPC failed, so every image in the chunk gets the same error
+                fresh.extend([chunk_result] * len(chunk))
+            else:
+                fresh.extend(chunk_result)
+
+        fresh_by_key = dict(zip(miss_keys, fresh))
+        for key, result in fresh_by_key.items():
+            if not isinstance(result, BaseException):
+                self._cache_put(key, result)
+
+        return [
+            result if result is not None else fresh_by_key[key]
+            for key, result in zip(keys, results)
+        ]
+
+    def _chunk_requests(self, contents: list[bytes]) -> list[list[bytes]]:
+        """
+        Split images into consecutive chunks that each fit in one batch_annotate_images call,
+        by image count (also capped at the rate limit) and by total size.
+        """
+        # A chunk takes one rate limiter token per image, so it can never be bigger than VISION_RPS
+        max_images = min(self.MAX_IMAGES_PER_REQUEST, max(1, int(self._limiter.max_rate)))
+        chunks = []
+        chunk, chunk_bytes = [], 0
+        for content in contents:
+            if chunk and (
+                len(chunk) >= max_images
+                or chunk_bytes + len(content) > self.MAX_REQUEST_BYTES
+            ):
+                chunks.append(chunk)
+                chunk, chunk_bytes = [], 0
+            chunk.append(content)
+            chunk_bytes += len(content)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    async def _annotate_batch_async(self, contents: list[bytes]) -> list:
+        async with self._semaphore:
+            return await self._run_limited(len(contents), self._annotate_batch, contents)
+
+    def _annotate_batch(self, contents: list[bytes]) -> list:
+        """
+        Send a single batch_annotate_images request for up to MAX_IMAGES_PER_REQUEST images.
+        """
+        requests = [self._build_request(content) for content in contents]
+        response = self._batch_annotate_images(requests)
+
+        results = []
+        for content, image_response in zip(contents, response.responses):
+            try:
+                results.append(self._parse_response(image_response, content))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def extract_metadata(self, image_content: bytes, exif: bool = True) -> dict:
         """
         Extract metadata from image bytes.
+        Dimensions are read from the file header directly, PIL is only used for formats it cannot parse.
+        :param exif: Whether to include EXIF tags.
         """
         metadata = {
             "file_size_kb": round(len(image_content) / 1024, 2)
         }
         try:
-            img = Image.open(io.BytesIO(image_content))
+            dims = _fast_dims(image_content)
+            if dims is None:
+                img = Image.open(io.BytesIO(image_content))
+                dims = (img.format, img.width, img.height, img.mode)
+            image_format, width, height, mode = dims
+
             metadata.update({
-                "format": img.format,
-                "mode": img.mode,
-                "width": img.width,
-                "height": img.height,
+                "format": image_format,
+                "mode": mode,
+                "width": width,
+                "height": height,
             })
             
-            # Extract EXIF data
-            exif_data = img._getexif()
+            # PIL reports multi-picture JPEGs (common from phone cameras) as MPO
+            exif_data = None
+            if exif and image_format in ("JPEG", "MPO"):
+                exif_data = self._extract_exif(image_content)
+            elif exif:
+                # piexif only reads JPEG; other formats (e.g. PNG eXIf chunks) go through PIL as before
+                exif_data = self._extract_exif_pil(image_content)
             if exif_data:
-                exif = {}
-                for tag_id, value in exif_data.items():
-                    tag = TAGS.get(tag_id, tag_id)
-                    # Handle bytes values in EXIF
-                    if isinstance(value, bytes):
-                        try:
-                            value = value.decode(errors='replace')
-                        except:
-                            value = str(value)
-                    exif[str(tag)] = str(value)
-                metadata["exif"] = exif
+                metadata["exif"] = exif_data
         except Exception as e:
             metadata["error"] = f"Metadata extraction failed: {str(e)}"
         
         return metadata
+
+    def _convert_exif_value(self, value, tag_type, decode_bytes: bool = True):
+        try:
+            return _exif_value(value, tag_type, decode_bytes)
+        except Exception:
+            # Keep the raw value rather than losing the whole EXIF block over one odd tag
+            if decode_bytes and isinstance(value, bytes):
+                return value.decode(errors='replace')
+            return value
+
+    def _extract_exif(self, image_content: bytes) -> dict:
+        """
+        Read EXIF tags straight from the JPEG APP1 segment with piexif, without decoding the image.
+        """
+        exif_data = piexif.load(image_content)
+        exif = {}
+        # Same layout as PIL's _getexif: 0th and Exif IFD tags merged, GPS IFD nested under GPSInfo
+        for ifd in ("0th", "Exif"):
+            for tag_id, value in exif_data.get(ifd, {}).items():
+                if ifd == "0th" and tag_id == piexif.ImageIFD.GPSTag:
+                    continue
+                # piexif is only used for parsing, tags keep PIL's names
+                tag = TAGS.get(tag_id, tag_id)
+                tag_type = piexif.TAGS[ifd].get(tag_id, {}).get("type")
+                exif[str(tag)] = str(self._convert_exif_value(value, tag_type))
+
+        if piexif.ImageIFD.GPSTag in exif_data.get("0th", {}):
+            gps_info = {}
+            for tag_id, value in exif_data.get("GPS", {}).items():
+                tag_type = piexif.TAGS["GPS"].get(tag_id, {}).get("type")
+                gps_info[tag_id] = self._convert_exif_value(value, tag_type, decode_bytes=False)
+            exif["GPSInfo"] = str(gps_info)
+        return exif
+
+    def _extract_exif_pil(self, image_content: bytes) -> dict:
+        """
+        Read EXIF tags through PIL, for formats piexif does not support.
+        """
+        img = Image.open(io.BytesIO(image_content))
+        exif_data = img._getexif() if hasattr(img, "_getexif") else None
+        exif = {}
+        if exif_data:
+            for tag_id, value in exif_data.items():
+                tag = TAGS.get(tag_id, tag_id)
+                # Handle bytes values in EXIF
+                if isinstance(value, bytes):
+                    value = value.decode(errors='replace')
+                exif[str(tag)] = str(value)
+        return exif